@@ -1,11 +1,48 @@
 import json
-import google.generativeai as genai
-from google.ai.generativelanguage_v1beta.types import content
+import threading
+
+# The Gemini SDK drags in protobuf and grpc and is slow to import, so it is loaded on first use
+genai = None
+content = None
+_sdk_lock = threading.Lock()
+
+def load_sdk():
+    global genai, content
+    with _sdk_lock:
+        if genai is None:
+            import google.generativeai as sdk
+            from google.ai.generativelanguage_v1beta.types import content as sdk_content
+            genai, content = sdk, sdk_content
+    return genai
+
+def point_sdk_at(endpoint):
+    """Send every SDK call, file uploads included, to a generative-language endpoint such as the local stand-in."""
+    import google.generativeai.client as sdk_client
+    # The SDK fetches the File API discovery document from a fixed URL instead of the configured endpoint
+    sdk_client.GENAI_API_DISCOVERY_URL = f"{endpoint}/$discovery/rest"
+
+MODEL_NAME = "gemini-2.0-flash"
+# Upper bound on one generateContent call, so a stalled request can't hang chapter generation
+REQUEST_TIMEOUT_SECONDS = 120
+SYSTEM_INSTRUCTION = "I will give you an audio snippet and a list of possible chapter titles. You respond in json tell me if one of those chapters is present in the audio clip and if so, which one"
 
 class AI:
-    def __init__(self, api_key):
+    def __init__(self, api_key, endpoint=None):
         self.api_key = api_key
-        genai.configure(api_key=api_key)
+        # When set, the SDK talks REST to this endpoint (e.g. the local stand-in) instead of the real API
+        self.endpoint = endpoint.rstrip('/') if endpoint else None
+        self.configured = False
+
+    def load(self):
+        """Import and configure the SDK. Called from the startup warm-up, and lazily by query_gemini."""
+        if self.configured:
+            return
+        if self.endpoint is None:
+            load_sdk().configure(api_key=self.api_key)
+        else:
+            load_sdk().configure(api_key=self.api_key, transport='rest', client_options={'api_endpoint': self.endpoint})
+            point_sdk_at(self.endpoint)
+        self.configured = True
 
 
     def has_api_key(self):
@@ -24,6 +61,7 @@ class AI:
         return contains_chapter, chapter
 
     def query_gemini(self, clip_path, chapters):
+        self.load()
         clip = genai.upload_file(path=clip_path)
         toc_text = "\n".join(chapters)
 
@@ -50,11 +88,11 @@ class AI:
         }
 
         model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
+            model_name=MODEL_NAME,
             generation_config=generation_config,
-            system_instruction="I will give you an audio snippet and a list of possible chapter titles. You respond in json tell me if one of those chapters is present in the audio clip and if so, which one",
+            system_instruction=SYSTEM_INSTRUCTION,
             )
         
-        response = model.generate_content([toc_text, clip])
+        response = model.generate_content([toc_text, clip], request_options={"timeout": REQUEST_TIMEOUT_SECONDS})
 
         return self.parse_gemini_response(response.text, chapters)
@@ -1,20 +1,29 @@
 import base64
 from io import BytesIO
+import itertools
 import json
 import logging
 import os
 import sys
 import tempfile
-from flask import Flask, jsonify, request, send_file
+import threading
+import time
+from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 
 from ai import AI
+import fingerprint
 import parser
+from uploads import DEFAULT_CHUNK_SIZE, DEFAULT_TTL_HOURS, UploadError, UploadStore, file_sha256
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
 ai = None
+# Set once the SDK is imported and ffmpeg has been probed, see warm_up()
+warm = threading.Event()
+uploads = UploadStore(os.getenv('UPLOAD_DIR'), float(os.getenv('UPLOAD_TTL_HOURS', DEFAULT_TTL_HOURS)))
+fingerprints = fingerprint.FingerprintIndex(fingerprint.default_index_path())
 
 # Configure logging
 logging.basicConfig(
@@ -32,32 +41,168 @@ def add_cors_headers(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'X-Chapter-Count')
     return response
 
+@app.errorhandler(UploadError)
+def handle_upload_error(e):
+    return jsonify({"error": str(e)}), e.status
+
+class AudioSource:
+    """Audio on disk, either a multipart file saved to a temp file we own or a finished chunked upload."""
+    def __init__(self, filename, path, owned, sha256=None):
+        self.filename = filename
+        self.path = path
+        self.owned = owned
+        self.known_sha256 = sha256
+
+    def sha256(self):
+        """The file's SHA-256; chunked uploads already checked it when they were finalized."""
+        if self.known_sha256 is None:
+            self.known_sha256 = file_sha256(self.path)
+        return self.known_sha256
+
+    def detach(self):
+        """Hand the temp file to the caller, who then has to remove it. Returns whether it was ours."""
+        owned = self.owned
+        self.owned = False
+        return owned
+
+    def cleanup(self):
+        if self.owned and os.path.exists(self.path):
+            os.remove(self.path)
+
+def get_audio_source(field):
+    """Return the AudioSource for a multipart file or an uploadId, or None if neither was sent."""
+    if field in request.files:
+        file = request.files[field]
+        suffix = os.path.splitext(file.filename)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as audiobook_file:
+            audiobook_path = audiobook_file.name
+        file.save(audiobook_path)
+        return AudioSource(file.filename, audiobook_path, True)
+    if 'uploadId' in request.form:
+        # Chunked uploads are already on disk; use them in place
+        filename, path, sha256 = uploads.get_completed(request.form['uploadId'])
+        return AudioSource(filename, path, False, sha256)
+    return None
+
+def lookup_known_chapters(audiobook_path):
+    """Match the upload against books we've already exported chapters for."""
+    # Don't decode anything until there is at least one book to match against
+    if fingerprints.is_empty():
+        return None
+    duration = parser.get_audio_duration(audiobook_path)
+    anchors = fingerprint.fingerprint_query(audiobook_path, duration.total_seconds())
+    return fingerprints.lookup(anchors)
+
+def index_exported_book(audiobook_path, remove_after, sha256, chapters, title, author, duration):
+    """Store the book's fingerprint with its finished chapters, reusing the one from /generateChapters if we have it."""
+    try:
+        sha256 = sha256 or file_sha256(audiobook_path)
+        hashes = fingerprints.recall(sha256)
+        if hashes is None:
+            hashes = fingerprint.fingerprint_file(audiobook_path)
+        fingerprints.add_book(sha256, hashes, chapters, title, author, duration.total_seconds())
+    except Exception as e:
+        logger.warning(f"Could not index exported book: {e}")
+    finally:
+        if remove_after:
+            os.remove(audiobook_path)
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    body = request.get_json(silent=True) or {}
+    if not all(key in body for key in ('filename', 'size')):
+        return jsonify({"error": "filename and size are required"}), 400
+
+    try:
+        size = int(body['size'])
+        chunk_size = int(body.get('chunkSize', DEFAULT_CHUNK_SIZE))
+    except (TypeError, ValueError):
+        raise UploadError("size and chunkSize must be integers")
+
+    meta = uploads.create(str(body['filename']), size, chunk_size)
+    return jsonify(uploads.status(meta['uploadId'])), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    return jsonify(uploads.status(upload_id)), 200
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    written = uploads.write_chunk(upload_id, index, request.stream)
+    return jsonify({"index": index, "size": written}), 200
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    body = request.get_json(silent=True) or {}
+    if 'sha256' not in body:
+        return jsonify({"error": "sha256 is required"}), 400
+
+    uploads.finalize(upload_id, body['sha256'])
+    return jsonify(uploads.status(upload_id)), 200
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    uploads.delete(upload_id)
+    return '', 204
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    if not warm.is_set():
+        return jsonify({"ready": False}), 503
+
+    capabilities = parser.ffmpeg_capabilities()
+    missing = [e for e in parser.REQUIRED_ENCODERS if e not in capabilities['encoders']]
+    missing += [f for f in parser.REQUIRED_FILTERS if f not in capabilities['filters']]
+    is_ready = capabilities['ffmpeg'] and capabilities['ffprobe'] and not missing
+
+    return jsonify({
+        "ready": is_ready,
+        "ffmpeg": capabilities['version'],
+        "ffprobe": capabilities['ffprobe'],
+        "missing": missing,
+        "ai": ai is not None
+    }), 200 if is_ready else 503
+
 @app.route('/hasApiKey', methods=['GET'])
 def has_api_key():
     return jsonify({"hasApiKey": ai.has_api_key()}), 200
 
 @app.route('/detectChapters', methods=['POST'])
 def detect_chapters():
-    if 'audiobook' not in request.files:
-        return jsonify({"error": "audiobook is required"}), 400
-
-    file = request.files['audiobook']
-    file_bytes = file.read()
-    metadata = parser.extract_chapter_headers(file_bytes)
+    source = get_audio_source('audiobook')
+    if source is None:
+        return jsonify({"error": "audiobook or uploadId is required"}), 400
 
     try:
-        thumbnail_bytes = parser.extract_thumbnail(file_bytes)
-    except Exception as e:
-        thumbnail_bytes = None
-        logger.info(f"Error extracting thumbnail: {e}")
-
-    response_data = {
-        "chapters": metadata['chapters'],
-        "title": metadata['title'],
-        "author": metadata['author']
-    }
+        metadata = parser.extract_chapter_headers_from_path(source.path)
+
+        try:
+            thumbnail_bytes = parser.extract_thumbnail(source.path)
+        except Exception as e:
+            thumbnail_bytes = None
+            logger.info(f"Error extracting thumbnail: {e}")
+
+        response_data = {
+            "chapters": metadata['chapters'],
+            "title": metadata['title'],
+            "author": metadata['author']
+        }
+
+        # No embedded chapters, but we may have chapterized another encoding of this book before
+        if not metadata['chapters']:
+            try:
+                match = lookup_known_chapters(source.path)
+            except Exception as e:
+                match = None
+                logger.info(f"Error looking up fingerprint: {e}")
+            if match:
+                response_data["chapters"] = match['chapters']
+                response_data["fingerprintMatch"] = {key: match[key] for key in ('title', 'author', 'offset', 'drift', 'bitErrorRate')}
+    finally:
+        source.cleanup()
 
     if thumbnail_bytes:
         thumbnail_base64 = base64.b64encode(thumbnail_bytes).decode('utf-8')
@@ -68,29 +213,39 @@ def detect_chapters():
 @app.route('/generateChapters', methods=['POST'])
 def generate_chapters():
     # Parse table of contents, audio file, and number of silences
-    if not all(key in request.form for key in ('tableOfContents', 'numSilences', 'sampleRate', 'existingChapters')) or 'audioFile' not in request.files:
+    if not all(key in request.form for key in ('tableOfContents', 'numSilences', 'sampleRate', 'existingChapters')):
         return jsonify({"error": "tableOfContents, audioFile, sampleRate, existingChapters, and numSilences are required"}), 400
-    
-    audio_file = request.files['audioFile']
-    audio_bytes = audio_file.read()
+
     num_silences = int(request.form['numSilences'])
     table_of_contents = json.loads(request.form['tableOfContents'])
     sample_rate = int(request.form['sampleRate'])
     existing_chapters = json.loads(request.form['existingChapters'])
     num_existing = len(existing_chapters)
 
+    source = get_audio_source('audioFile')
+    if source is None:
+        return jsonify({"error": "audioFile or uploadId is required"}), 400
+
     logger.info(f'Sample rate: {sample_rate}')
     logger.info(f'Number of silences: {num_silences}')
     logger.info(f'Number of existing chapters: {num_existing}')
-    file_extension = os.path.splitext(audio_file.filename)[1]
 
-    # make temporary file
-    with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as audiobook_file:
-        audiobook_path = audiobook_file.name
-        audiobook_file.write(audio_bytes)
+    audiobook_path = source.path
     try:
         # Add some extra silences to account for potential missed silences
-        largest_silences = parser.find_largest_silences(audio_bytes, num_silences, num_existing, sample_rate, audiobook_path)
+        # Fingerprint from the silence scan's decode so /exportChapters can index the book for free
+        try:
+            fingerprinter = fingerprint.Fingerprinter()
+        except ImportError as e:
+            fingerprinter = None
+            logger.info(f"Fingerprinting unavailable: {e}")
+        largest_silences = parser.find_largest_silences(None, num_silences, num_existing, sample_rate, audiobook_path, fingerprinter)
+        if fingerprinter is not None:
+            # Only a cache for /exportChapters, so it must never fail chapter generation
+            try:
+                fingerprints.remember(source.sha256(), fingerprinter.hashes)
+            except Exception as e:
+                logger.warning(f"Could not cache fingerprint: {e}")
         logger.info(f"Found {len(largest_silences)} largest silences")
 
 
@@ -125,7 +280,7 @@ def generate_chapters():
             chapter_index += 1
     finally:
         # Clean up the temporary file
-        os.remove(audiobook_path)
+        source.cleanup()
 
     # Combine existing chapters with new chapters
     all_chapters = existing_chapters + chapters
@@ -140,28 +295,31 @@ def generate_chapters():
 
 @app.route('/exportChapters', methods=['POST'])
 def export_chapters():
-    if 'file' not in request.files:
-        return jsonify({"error": "file is required"}), 400
     if not all(key in request.form for key in ('filename', 'chapters', 'title', 'author')):
         return jsonify({"error": "filename, chapters, title, and author are required"}), 400
 
     logger.info("Exporting chapters")
 
-    file = request.files['file']
     thumbnail = request.files['thumbnail'] if 'thumbnail' in request.files else None
     filename = request.form['filename'] # TODO: remove can use file.filename??
     chapters = json.loads(request.form['chapters'])
     title = request.form['title']
     author = request.form['author']
 
-    file_bytes = file.stream.read()
     thumbnail_bytes = thumbnail.stream.read() if thumbnail else None
 
-    suffix = os.path.splitext(file.filename)[1]
+    source = get_audio_source('file')
+    if source is None:
+        return jsonify({"error": "file or uploadId is required"}), 400
 
-    metadata_string = parser.construct_metadata(chapters, title, author, parser.get_audio_length(file_bytes, suffix))
-    logger.info("Constructed metadata")
-    output_bytes = parser.merge_metadata_with_audio(file_bytes, metadata_string, suffix, thumbnail_bytes)
+    try:
+        audio_length = parser.get_audio_duration(source.path)
+        metadata_string = parser.construct_metadata(chapters, title, author, audio_length)
+        logger.info("Constructed metadata")
+        output_bytes = parser.merge_metadata_with_audio(source.path, metadata_string, thumbnail_bytes)
+    except Exception:
+        source.cleanup()
+        raise
 
     output_stream = BytesIO(output_bytes)
     output_stream.seek(0)
@@ -169,14 +327,119 @@ def export_chapters():
     # split the filename and extension, then return name + .m4b
     download_name = os.path.splitext(filename)[0] + ".m4b"
 
+    threading.Thread(
+        target=index_exported_book,
+        args=(source.path, source.detach(), source.known_sha256, chapters, title, author, audio_length),
+        daemon=True
+    ).start()
+
     logger.info("Exported chapters, returning file")
     return send_file(output_stream, as_attachment=True, download_name=download_name, mimetype="audio/m4b")
 
+@app.route('/exportChapterFiles', methods=['POST'])
+def export_chapter_files():
+    if 'file' not in request.files and 'uploadId' not in request.form:
+        return jsonify({"error": "file or uploadId is required"}), 400
+    if not all(key in request.form for key in ('filename', 'chapters', 'title', 'author')):
+        return jsonify({"error": "filename, chapters, title, and author are required"}), 400
+
+    logger.info("Exporting chapter files")
+
+    thumbnail = request.files['thumbnail'] if 'thumbnail' in request.files else None
+    filename = request.form['filename']
+    chapters = json.loads(request.form['chapters'])
+    title = request.form['title']
+    author = request.form['author']
+
+    if not chapters:
+        return jsonify({"error": "at least one chapter is required"}), 400
+
+    thumbnail_bytes = thumbnail.stream.read() if thumbnail else None
+
+    source = get_audio_source('file')
+    audiobook_path = source.path
+    owns_source = source.detach()
+
+    try:
+        total_length = parser.get_audio_duration(audiobook_path)
+    except Exception:
+        if owns_source:
+            os.remove(audiobook_path)
+        raise
+
+    # Catch bad times before any headers go out; a cut failing mid-stream can only abort the response
+    try:
+        parser.check_chapter_times(chapters, total_length)
+    except ValueError as e:
+        if owns_source:
+            os.remove(audiobook_path)
+        return jsonify({"error": str(e)}), 400
+
+    files = parser.split_audio_by_chapters(audiobook_path, chapters, title, author, total_length, thumbnail_bytes)
+
+    # Cut the first chapter before sending headers so a source ffmpeg can't handle is a proper error
+    try:
+        first = next(files)
+    except Exception as e:
+        files.close()
+        if owns_source:
+            os.remove(audiobook_path)
+        logger.error(f"Error exporting chapter files: {e}")
+        return jsonify({"error": f"Failed to cut chapters: {e}"}), 500
+
+    def generate():
+        try:
+            yield from parser.stream_zip(itertools.chain([first], files))
+            logger.info(f"Exported {len(chapters)} chapter files")
+        except Exception as e:
+            # Headers are already sent; raising aborts the connection so the client never
+            # mistakes a truncated archive for a complete one
+            logger.error(f"Chapter file export failed mid-stream: {e}")
+            raise
+        finally:
+            files.close()
+            if owns_source:
+                os.remove(audiobook_path)
+
+    download_name = os.path.splitext(filename)[0] + ".zip"
+    return Response(
+        generate(),
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{download_name}"',
+            "X-Chapter-Count": str(len(chapters))
+        }
+    )
+
 logger.info("Starting server...")
 gemini_api_key = os.getenv('GEMINI_API_KEY')
 if not gemini_api_key:
     logger.warning("GEMINI_API_KEY environment variable not set")
 else:
     logger.info("GEMINI_API_KEY found")
-    ai = AI(gemini_api_key)
-app.run(port=8089, debug=True)
\ No newline at end of file
+    gemini_api_endpoint = os.getenv('GEMINI_API_ENDPOINT')
+    if gemini_api_endpoint:
+        logger.info(f"Using Gemini endpoint override: {gemini_api_endpoint}")
+    ai = AI(gemini_api_key, gemini_api_endpoint)
+
+def warm_up():
+    # Pay for the slow imports and the ffmpeg probe off the request path
+    start = time.perf_counter()
+    try:
+        parser.ffmpeg_capabilities()
+        if ai is not None:
+            ai.load()
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+    logger.info(f"Warm-up finished in {time.perf_counter() - start:.2f}s")
+    warm.set()
+
+# WARM_UP=0 skips it, e.g. for bench_startup.py, which only wants to time the imports; the
+# first request (or /ready) then pays for the loading instead
+if os.getenv('WARM_UP', '1') != '0':
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+else:
+    warm.set()
+
+if __name__ == "__main__":
+    app.run(port=8089, debug=True)
\ No newline at end of file
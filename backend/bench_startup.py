@@ -0,0 +1,88 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Import-time benchmark for the backend. Fails when importing app.py gets slower than the budget,
+# when a heavy dependency sneaks back onto the import path, or when the import writes to disk.
+#
+#   python bench_startup.py --runs 5 --budget-ms 1000
+
+HEAVY_MODULES = ['google.generativeai', 'google.protobuf', 'grpc', 'numpy', 'tqdm', 'requests']
+
+PROBE = f"""
+import json, sys
+import app
+print('HEAVY=' + json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))
+"""
+
+def measure_once():
+    """
+    Import app in a fresh interpreter and return (import microseconds, heavy modules loaded,
+    slowest imports, files the import created in the index and upload locations).
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        env = {
+            **os.environ,
+            'PYTHONDONTWRITEBYTECODE': '1',
+            # Keep the timed import away from ffmpeg and the real index and uploads
+            'WARM_UP': '0',
+            'FINGERPRINT_INDEX': os.path.join(scratch, 'fingerprints.sqlite'),
+            'UPLOAD_DIR': os.path.join(scratch, 'uploads')
+        }
+        env.pop('GEMINI_API_KEY', None)
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            capture_output=True,
+            text=True
+        )
+        created = sorted(os.listdir(scratch))
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing app failed: {process.stderr[-2000:]}")
+
+    # Lines look like "import time:       245 |      18043 | app"
+    timings = []
+    for match in re.finditer(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$', process.stderr, re.MULTILINE):
+        timings.append((int(match.group(2)), len(match.group(3)), match.group(4)))
+
+    app_us = next(cumulative for cumulative, depth, name in timings if name == 'app' and depth == 0)
+    top_level = sorted((t for t in timings if t[1] == 2), reverse=True)[:5]
+    heavy = json.loads(re.search(r'^HEAVY=(.*)$', process.stdout, re.MULTILINE).group(1))
+    return app_us, heavy, top_level, created
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Measure how long importing the backend takes")
+    arg_parser.add_argument('--runs', type=int, default=5)
+    arg_parser.add_argument('--budget-ms', type=float, default=1000.0)
+    args = arg_parser.parse_args()
+
+    samples = []
+    created = set()
+    for _ in range(args.runs):
+        app_us, heavy, top_level, run_created = measure_once()
+        samples.append(app_us / 1000)
+        created.update(run_created)
+
+    median_ms = statistics.median(samples)
+    print(f"import app: median {median_ms:.0f} ms over {args.runs} runs (min {min(samples):.0f}, max {max(samples):.0f})")
+    print("slowest direct imports:")
+    for cumulative, _, name in top_level:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported eagerly: {', '.join(heavy)}")
+        failed = True
+    if created:
+        print(f"FAIL: importing app created {', '.join(sorted(created))}")
+        failed = True
+    if median_ms > args.budget_ms:
+        print(f"FAIL: import took {median_ms:.0f} ms, budget is {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,397 @@
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Acoustic fingerprints: a 32-bit hash of each one-second window, taken every HOP_SECONDS. Each
+# bit is the sign of how the energy difference between two neighbouring frequency bands changed
+# since the window one second earlier, which survives re-encoding at a different bitrate or codec
+# far better than the samples do. The small hop keeps hashes matching when two encodings don't
+# start on the same sample.
+SAMPLE_RATE = 8000
+WINDOW_SECONDS = 1.0
+HOP_SECONDS = 0.1
+NUM_BITS = 32
+MIN_FREQ = 250
+MAX_FREQ = 3500
+SILENCE_RMS = 100
+
+# How much of the head and tail of an upload is decoded to look it up
+QUERY_SECONDS = 240
+# Re-encoding flips some bits in most hashes, so lookups also try every combination of the
+# WEAK_BITS least reliable bits of each query hash (Haitsma & Kalker)
+WEAK_BITS = 6
+# Chance agreement on an offset stays well below MIN_VOTES. Up to MAX_BIT_ERROR_RATE, the near
+# misses still bring about MIN_VOTES of the head's anchors to their frame, so every alignment
+# the bit error check would accept can also be found; random alignments sit near 0.5
+MIN_VOTES = 10
+MAX_BIT_ERROR_RATE = 0.28
+# Books whose best head offset is checked bit by bit before picking the match
+CANDIDATE_BOOKS = 3
+# Fingerprints from /generateChapters that were never exported are dropped after this long
+PENDING_DAYS = 7
+
+def ffmpeg_pcm_args():
+    """Output options that make ffmpeg emit the PCM stream Fingerprinter expects."""
+    return ['-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le']
+
+class Fingerprinter:
+    """Turns a stream of mono s16le PCM at SAMPLE_RATE into hashes, feed() as many times as needed."""
+
+    def __init__(self):
+        import numpy as np
+        self.np = np
+        self.window = int(WINDOW_SECONDS * SAMPLE_RATE)
+        self.hop = int(HOP_SECONDS * SAMPLE_RATE)
+        self.lag = int(round(WINDOW_SECONDS / HOP_SECONDS))
+        self.pending = b''
+        self.samples = np.zeros(0, dtype=np.float32)
+        self.previous = None
+        self.hashes = array('I')
+        self.weak_bits = array('I')
+
+        freqs = np.fft.rfftfreq(self.window, 1 / SAMPLE_RATE)
+        edges = np.geomspace(MIN_FREQ, MAX_FREQ, NUM_BITS + 2)
+        self.band_starts = np.searchsorted(freqs, edges[:-1])
+        self.band_stop = np.searchsorted(freqs, edges[-1])
+        self.weights = np.hanning(self.window).astype(np.float32)
+
+    def feed(self, data):
+        np = self.np
+        data = self.pending + data
+        usable = len(data) - len(data) % 2
+        self.pending = data[usable:]
+        self.samples = np.concatenate([self.samples, np.frombuffer(data[:usable], dtype=np.int16).astype(np.float32)])
+
+        if len(self.samples) < self.window:
+            return
+        count = 1 + (len(self.samples) - self.window) // self.hop
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples, self.window)[::self.hop][:count]
+        self._hash_frames(frames)
+        self.samples = self.samples[count * self.hop:]
+
+    def _hash_frames(self, frames):
+        np = self.np
+        power = np.abs(np.fft.rfft(frames * self.weights, axis=1)) ** 2
+        bands = np.log(np.add.reduceat(power[:, :self.band_stop], self.band_starts, axis=1) + 1e-9)
+        diffs = bands[:, :-1] - bands[:, 1:]
+        silent = np.sqrt(np.mean(frames ** 2, axis=1)) < SILENCE_RMS
+
+        # Compare against the window that ended where this one starts
+        if self.previous is None:
+            self.previous = np.repeat(diffs[:1], self.lag, axis=0)
+        history = np.vstack([self.previous, diffs])
+        changes = diffs - history[:len(diffs)]
+        self.previous = history[-self.lag:]
+
+        bits = (changes > 0).astype(np.uint64) << np.arange(NUM_BITS, dtype=np.uint64)
+        hashes = bits.sum(axis=1)
+        hashes[silent] = 0  # 0 marks frames with nothing to match on
+        self.hashes.extend(int(h) for h in hashes)
+
+        # The bits whose change was closest to zero are the likeliest to flip in another encoding
+        weakest = np.argpartition(np.abs(changes), WEAK_BITS, axis=1)[:, :WEAK_BITS]
+        masks = (np.uint64(1) << weakest.astype(np.uint64)).sum(axis=1)
+        self.weak_bits.extend(int(m) for m in masks)
+
+def fingerprint_file(path, start=None, duration=None):
+    """Decode path (or the given slice of it, in seconds) and return its hashes."""
+    return _fingerprint(path, start, duration).hashes
+
+def _fingerprint(path, start=None, duration=None):
+    command = ['ffmpeg', '-v', 'error']
+    if start is not None:
+        command.extend(['-ss', f'{start:.3f}'])
+    command.extend(['-i', path])
+    if duration is not None:
+        command.extend(['-t', f'{duration:.3f}'])
+    command.extend([*ffmpeg_pcm_args(), 'pipe:1'])
+
+    fingerprinter = Fingerprinter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for block in iter(lambda: process.stdout.read(1024 * 1024), b''):
+        fingerprinter.feed(block)
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg exited with {process.returncode} while fingerprinting")
+    return fingerprinter
+
+def fingerprint_query(path, duration_seconds):
+    """
+    Fingerprint only the head and tail of path. Returns [(query_seconds, hash, weak_bits)]
+    anchors, the tail is what lets lookup() measure drift between two encodings.
+    """
+    head = _fingerprint(path, duration=QUERY_SECONDS)
+    anchors = [(i * HOP_SECONDS, h, w) for i, (h, w) in enumerate(zip(head.hashes, head.weak_bits))]
+    tail_start = duration_seconds - QUERY_SECONDS
+    if tail_start > QUERY_SECONDS:
+        tail = _fingerprint(path, start=tail_start)
+        anchors.extend((tail_start + i * HOP_SECONDS, h, w) for i, (h, w) in enumerate(zip(tail.hashes, tail.weak_bits)))
+    return [anchor for anchor in anchors if anchor[1]]
+
+def _bit_errors(a, b):
+    return bin(a ^ b).count('1')
+
+def _near_misses(h, weak_bits):
+    """h with every combination of the bits in weak_bits flipped, h itself included."""
+    candidates = [h]
+    bit = 1
+    while weak_bits:
+        if weak_bits & bit:
+            candidates.extend([c ^ bit for c in candidates])
+            weak_bits &= ~bit
+        bit <<= 1
+    return candidates
+
+def _best_offset(offset_votes, in_range):
+    """
+    The offset with the most votes from anchors in range, counting the frames either side of
+    it as well since an offset between two frames splits its votes. Returns (offset, votes, times).
+    """
+    counts = Counter({offset: sum(1 for t in times if in_range(t)) for offset, times in offset_votes.items()})
+    offset = max(counts, key=lambda o: (counts[o - 1] + counts[o] + counts[o + 1], counts[o]))
+    times = [t for o in (offset - 1, offset, offset + 1) for t in offset_votes.get(o, []) if in_range(t)]
+    return offset, len(times), times
+
+def _frame_at(offset, slope=0.0, pivot=0.0):
+    """Map query seconds to a book frame, with book_time = t + offset + slope * (t - pivot)."""
+    return lambda t: round((t + offset * HOP_SECONDS + slope * (t - pivot)) / HOP_SECONDS)
+
+def _is_head(t):
+    return t < QUERY_SECONDS
+
+def _is_tail(t):
+    return t >= QUERY_SECONDS
+
+def _bit_error_rate(anchors, fingerprint, frame_at):
+    errors = 0
+    compared = 0
+    for t, h, _ in anchors:
+        frame = frame_at(t)
+        if 0 <= frame < len(fingerprint) and fingerprint[frame]:
+            errors += _bit_errors(h, fingerprint[frame])
+            compared += NUM_BITS
+    return errors / compared if compared else 1.0
+
+class FingerprintIndex:
+    """
+    SQLite index of fingerprinted books and their finished chapter lists, plus a cache of
+    fingerprints computed before the chapters were known (keyed by the file's SHA-256).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Tables are created on first use, so constructing the index (e.g. importing app) writes nothing
+        self.created = False
+        self.create_lock = threading.Lock()
+
+    def _create_tables(self, db):
+        with self.create_lock:
+            if self.created:
+                return
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS books (
+                    id INTEGER PRIMARY KEY,
+                    sha256 TEXT UNIQUE,
+                    title TEXT,
+                    author TEXT,
+                    duration REAL,
+                    chapters TEXT,
+                    fingerprint BLOB,
+                    created REAL
+                );
+                CREATE TABLE IF NOT EXISTS hashes (
+                    hash INTEGER,
+                    book_id INTEGER,
+                    frame INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (hash);
+                CREATE TABLE IF NOT EXISTS pending (
+                    sha256 TEXT PRIMARY KEY,
+                    fingerprint BLOB,
+                    created REAL
+                );
+            """)
+            self.created = True
+
+    @contextmanager
+    def _connect(self):
+        # A connection per call keeps this safe to use from request threads and background work
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            if not self.created:
+                self._create_tables(db)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def remember(self, sha256, hashes):
+        """Cache a full-file fingerprint until the book is exported with its chapters."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('DELETE FROM pending WHERE created < ?', (now - PENDING_DAYS * 86400,))
+            db.execute('INSERT OR REPLACE INTO pending VALUES (?, ?, ?)', (sha256, hashes.tobytes(), now))
+
+    def recall(self, sha256):
+        with self._connect() as db:
+            row = db.execute('SELECT fingerprint FROM pending WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is None:
+            return None
+        hashes = array('I')
+        hashes.frombytes(row[0])
+        return hashes
+
+    def is_empty(self):
+        """True until the first book is indexed, when there is nothing a lookup could match."""
+        with self._connect() as db:
+            return db.execute('SELECT 1 FROM books LIMIT 1').fetchone() is None
+
+    def add_book(self, sha256, hashes, chapters, title, author, duration):
+        with self._connect() as db:
+            existing = db.execute('SELECT id FROM books WHERE sha256 = ?', (sha256,)).fetchone()
+            if existing:
+                db.execute('DELETE FROM hashes WHERE book_id = ?', existing)
+                db.execute('DELETE FROM books WHERE id = ?', existing)
+            cursor = db.execute(
+                'INSERT INTO books (sha256, title, author, duration, chapters, fingerprint, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sha256, title, author, duration, json.dumps(chapters), hashes.tobytes(), time.time())
+            )
+            book_id = cursor.lastrowid
+            db.executemany(
+                'INSERT INTO hashes VALUES (?, ?, ?)',
+                ((h, book_id, frame) for frame, h in enumerate(hashes) if h)
+            )
+            db.execute('DELETE FROM pending WHERE sha256 = ?', (sha256,))
+        logger.info(f"Indexed '{title}' with {len(chapters)} chapters and {len(hashes)} hashes")
+
+    def _votes(self, db, anchors):
+        """Map (book_id, frame offset) to the query anchors that agree on it."""
+        by_hash = {}
+        for t, h, weak_bits in anchors:
+            for candidate in _near_misses(h, weak_bits):
+                by_hash.setdefault(candidate, []).append(t)
+
+        votes = {}
+        unique = list(by_hash)
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            rows = db.execute(
+                f'SELECT hash, book_id, frame FROM hashes WHERE hash IN ({",".join("?" * len(batch))})', batch
+            )
+            for h, book_id, frame in rows:
+                for t in by_hash[h]:
+                    offset = frame - round(t / HOP_SECONDS)
+                    votes.setdefault((book_id, offset), []).append(t)
+        return votes
+
+    def lookup(self, anchors):
+        """
+        Find the indexed book the anchors came from. Returns the book's chapters moved onto the
+        query's timeline, or None when nothing matches convincingly.
+        """
+        if not anchors:
+            return None
+
+        with self._connect() as db:
+            votes = self._votes(db, anchors)
+            if not votes:
+                return None
+
+            # Rank books by their strongest head offset. Their total votes would favour long books,
+            # whose scattered chance collisions add up without ever agreeing on an offset
+            by_book = {}
+            for (book_id, offset), times in votes.items():
+                by_book.setdefault(book_id, {})[offset] = times
+            peaks = sorted(
+                ((_best_offset(book_votes, _is_head), book_id) for book_id, book_votes in by_book.items()),
+                key=lambda peak: peak[0][1],
+                reverse=True
+            )
+            candidates = [(book_id, peak) for peak, book_id in peaks[:CANDIDATE_BOOKS] if peak[1] >= MIN_VOTES]
+            if not candidates:
+                return None
+
+            ids = [book_id for book_id, _ in candidates]
+            rows = {
+                row[0]: row[1:] for row in db.execute(
+                    f'SELECT id, title, author, duration, chapters, fingerprint FROM books WHERE id IN ({",".join("?" * len(ids))})', ids
+                )
+            }
+
+        # Check each candidate's alignment over every head anchor, not just the hash hits, at its
+        # best offset and the neighbouring ones, and keep the closest fit
+        head_anchors = [anchor for anchor in anchors if _is_head(anchor[0])]
+        tail_anchors = [anchor for anchor in anchors if _is_tail(anchor[0])]
+        best = None
+        for book_id, (peak_offset, _, times) in candidates:
+            book_fingerprint = array('I')
+            book_fingerprint.frombytes(rows[book_id][4])
+            rate, offset = min(
+                (_bit_error_rate(head_anchors, book_fingerprint, _frame_at(offset)), offset)
+                for offset in (peak_offset - 1, peak_offset, peak_offset + 1)
+            )
+            if best is None or rate < best[0]:
+                best = (rate, offset, book_id, times, book_fingerprint)
+
+        bit_error_rate, head_offset, book_id, head_times, fingerprint = best
+        title, author, duration, chapters, _ = rows[book_id]
+        if bit_error_rate > MAX_BIT_ERROR_RATE:
+            logger.info(f"Closest fingerprint match '{title}' rejected, bit error rate {bit_error_rate:.2f}")
+            return None
+
+        head_t = sum(head_times) / len(head_times)
+        book_votes = by_book[book_id]
+
+        # The head is confirmed, so the tail's best offset only has to pass the same bit error
+        # check over the tail to give the drift; if it doesn't, keep the match and assume none
+        slope = 0.0
+        tail_offset, tail_votes, tail_times = _best_offset(book_votes, _is_tail)
+        if tail_votes:
+            tail_t = sum(tail_times) / len(tail_times)
+            slopes = [(offset - head_offset) * HOP_SECONDS / (tail_t - head_t) for offset in (tail_offset - 1, tail_offset, tail_offset + 1)]
+            tail_error_rate, tail_slope = min(
+                (_bit_error_rate(tail_anchors, fingerprint, _frame_at(head_offset, s, head_t)), s) for s in slopes
+            )
+            if tail_error_rate <= MAX_BIT_ERROR_RATE:
+                slope = tail_slope
+                bit_error_rate = _bit_error_rate(anchors, fingerprint, _frame_at(head_offset, slope, head_t))
+            else:
+                logger.info(f"Ignoring drift for '{title}', tail bit error rate {tail_error_rate:.2f}")
+
+        # book_time = t + offset + slope * (t - head_t), solved for t
+        offset_seconds = head_offset * HOP_SECONDS
+        mapped = []
+        for chapter in json.loads(chapters):
+            t = (float(chapter['time']) - offset_seconds + slope * head_t) / (1 + slope)
+            mapped.append({**chapter, 'time': max(round(t, 3), 0)})
+
+        logger.info(f"Fingerprint matched '{title}': offset {offset_seconds:+.1f}s, drift {slope * 3600:+.2f}s/h, "
+                    f"bit error rate {bit_error_rate:.2f}")
+        return {
+            'title': title,
+            'author': author,
+            'chapters': mapped,
+            'offset': -offset_seconds,
+            'drift': slope,
+            'bitErrorRate': round(bit_error_rate, 3)
+        }
+
+def default_index_path():
+    return os.getenv('FINGERPRINT_INDEX', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fingerprints.sqlite'))
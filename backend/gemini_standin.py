@@ -0,0 +1,374 @@
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import synthetic
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Local stand-in for the subset of the generative-language REST API that the Gemini SDK uses
+# when AI.query_gemini runs with transport='rest': the File API discovery document, a resumable
+# upload of the clip, files.get and generateContent against it. Answers are scripted from the
+# marker tones in books produced by synthetic.generate_book.
+
+GENERATE_PATTERN = re.compile(r'^/v1beta/models/(?P<model>[^/:]+):generateContent$')
+FILE_PATTERN = re.compile(r'^/v1beta/(?P<name>files/[^/:]+)$')
+UPLOAD_PATH = '/upload/v1beta/files'
+
+def discovery_document(root_url):
+    """The part of the v1beta discovery document the SDK's upload_file needs, with uploads sent to root_url."""
+    file_schema = {
+        "id": "File",
+        "type": "object",
+        "properties": {key: {"type": "string"} for key in ("name", "displayName", "mimeType", "sizeBytes", "uri", "state")}
+    }
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "generativelanguage:v1beta",
+        "name": "generativelanguage",
+        "version": "v1beta",
+        "protocol": "rest",
+        "rootUrl": root_url,
+        "servicePath": "",
+        "baseUrl": root_url,
+        "batchPath": "batch",
+        "parameters": {
+            "key": {"type": "string", "location": "query"},
+            "alt": {"type": "string", "location": "query", "default": "json"}
+        },
+        "schemas": {
+            "File": file_schema,
+            "CreateFileRequest": {"id": "CreateFileRequest", "type": "object", "properties": {"file": {"$ref": "File"}}},
+            "CreateFileResponse": {"id": "CreateFileResponse", "type": "object", "properties": {"file": {"$ref": "File"}}}
+        },
+        "resources": {
+            "media": {
+                "methods": {
+                    "upload": {
+                        "id": "generativelanguage.media.upload",
+                        "path": "v1beta/files",
+                        "flatPath": "v1beta/files",
+                        "httpMethod": "POST",
+                        "parameters": {},
+                        "parameterOrder": [],
+                        "request": {"$ref": "CreateFileRequest"},
+                        "response": {"$ref": "CreateFileResponse"},
+                        "supportsMediaUpload": True,
+                        "mediaUpload": {
+                            "accept": ["*/*"],
+                            "maxSize": "2147483648",
+                            "protocols": {
+                                "simple": {"multipart": True, "path": UPLOAD_PATH},
+                                "resumable": {"multipart": True, "path": "/resumable" + UPLOAD_PATH}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+def parse_latency(spec):
+    """
+    Build a latency sampler (seconds) from a spec such as
+    'fixed:200', 'uniform:100,400', 'normal:300,50' or 'lognormal:300,0.5' (values in ms).
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',')] if args else []
+
+    if kind == 'none':
+        return lambda: 0.0
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0] / 1000
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(random.gauss(values[0], values[1]), 0) / 1000
+    if kind == 'lognormal' and len(values) == 2:
+        # values are the median in ms and the sigma of the underlying normal
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma) / 1000
+    raise argparse.ArgumentTypeError(f"invalid latency spec: {spec}")
+
+class RateLimiter:
+    """Requests-per-minute token bucket; returns False when the caller should get a 429."""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class StandinState:
+    def __init__(self, latency, error_429=0.0, error_500=0.0, rpm=None, wrong_answer=0.0,
+                 file_ttl=600.0, max_file_bytes=256 * 1024 * 1024):
+        self.latency = latency
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.limiter = RateLimiter(rpm) if rpm else None
+        self.wrong_answer = wrong_answer
+        # Like the real File API, files stay usable for repeated generateContent calls until
+        # they expire; the byte cap keeps a long load test's memory bounded
+        self.file_ttl = file_ttl
+        self.max_file_bytes = max_file_bytes
+        self.files = {}
+        self.file_bytes = 0
+        self.uploads = {}
+        self.files_lock = threading.Lock()
+        self.stats = {'upload': 0, 'generate': 0, '429': 0, '500': 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def _expire(self, now):
+        # Dicts keep insertion order, so the oldest entries come first; call with files_lock held
+        cutoff = now - self.file_ttl
+        while self.files:
+            name, (_, body, created) = next(iter(self.files.items()))
+            if created >= cutoff and self.file_bytes <= self.max_file_bytes:
+                break
+            del self.files[name]
+            self.file_bytes -= len(body)
+        for upload_id in [u for u, (_, created) in self.uploads.items() if created < cutoff]:
+            del self.uploads[upload_id]
+
+    def start_upload(self, mime_type):
+        upload_id = uuid.uuid4().hex
+        with self.files_lock:
+            self._expire(time.monotonic())
+            self.uploads[upload_id] = (mime_type, time.monotonic())
+        return upload_id
+
+    def finish_upload(self, upload_id, body):
+        """Store the uploaded bytes as a file. Returns (name, mime_type), or None for an unknown upload."""
+        with self.files_lock:
+            pending = self.uploads.pop(upload_id, None)
+            if pending is None:
+                return None
+            mime_type, _ = pending
+            name = f"files/{uuid.uuid4().hex[:16]}"
+            self.files[name] = (mime_type, body, time.monotonic())
+            self.file_bytes += len(body)
+            self._expire(time.monotonic())
+        return name, mime_type
+
+    def get_file(self, name):
+        """Return (mime_type, bytes) of a stored file, or None if it doesn't exist or has expired."""
+        with self.files_lock:
+            self._expire(time.monotonic())
+            stored = self.files.get(name)
+        return stored[:2] if stored else None
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'GeminiStandin/1.0'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, status, message, reason):
+        self.send_json(status, {"error": {"code": status, "message": message, "status": reason}})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def inject_failure(self):
+        """Apply rate limiting and random error injection. Returns True if a response was sent."""
+        if self.state.limiter and not self.state.limiter.allow():
+            self.state.count('429')
+            self.send_error_json(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED")
+            return True
+        roll = random.random()
+        if roll < self.state.error_429:
+            self.state.count('429')
+            self.send_error_json(429, "Resource has been exhausted (e.g. check quota).", "RESOURCE_EXHAUSTED")
+            return True
+        if roll < self.state.error_429 + self.state.error_500:
+            self.state.count('500')
+            self.send_error_json(500, "An internal error has occurred.", "INTERNAL")
+            return True
+        return False
+
+    @property
+    def root_url(self):
+        return f"http://{self.headers.get('Host', 'localhost')}/"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        file_match = FILE_PATTERN.match(path)
+        if path == '/stats':
+            with self.state.stats_lock:
+                self.send_json(200, dict(self.state.stats))
+        elif path == '/$discovery/rest':
+            self.send_json(200, discovery_document(self.root_url))
+        elif file_match:
+            self.handle_get_file(file_match.group('name'))
+        else:
+            self.send_error_json(404, f"Unknown path {path}", "NOT_FOUND")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+
+        if url.path == UPLOAD_PATH:
+            self.handle_upload_start(body)
+        elif GENERATE_PATTERN.match(url.path):
+            self.handle_generate(body)
+        else:
+            self.send_error_json(404, f"Unknown path {url.path}", "NOT_FOUND")
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+
+        upload_id = parse_qs(url.query).get('upload_id', [None])[0]
+        if url.path == UPLOAD_PATH and upload_id:
+            self.handle_upload_data(upload_id, body)
+        else:
+            self.send_error_json(404, f"Unknown path {url.path}", "NOT_FOUND")
+
+    def file_resource(self, name, mime_type, size):
+        return {
+            "name": name,
+            "mimeType": mime_type,
+            "sizeBytes": str(size),
+            "uri": f"{self.root_url}v1beta/{name}",
+            "state": "ACTIVE"
+        }
+
+    def handle_upload_start(self, body):
+        """First request of the resumable protocol: hand out the URL the clip is PUT to."""
+        time.sleep(self.state.latency() / 4)
+        if self.inject_failure():
+            return
+
+        upload_id = self.state.start_upload(self.headers.get('X-Upload-Content-Type', 'application/octet-stream'))
+
+        self.send_response(200)
+        self.send_header('Location', f"{self.root_url.rstrip('/')}{UPLOAD_PATH}?uploadType=resumable&upload_id={upload_id}")
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_upload_data(self, upload_id, body):
+        # The SDK sends clips this small in a single chunk
+        stored = self.state.finish_upload(upload_id, body)
+        if stored is None:
+            self.send_error_json(404, f"Upload {upload_id} not found", "NOT_FOUND")
+            return
+        name, mime_type = stored
+        self.state.count('upload')
+        self.send_json(200, {"file": self.file_resource(name, mime_type, len(body))})
+
+    def handle_get_file(self, name):
+        stored = self.state.get_file(name)
+        if stored is None:
+            self.send_error_json(404, f"File {name} not found", "NOT_FOUND")
+            return
+        mime_type, body = stored
+        self.send_json(200, self.file_resource(name, mime_type, len(body)))
+
+    def handle_generate(self, body):
+        time.sleep(self.state.latency())
+        if self.inject_failure():
+            return
+
+        request = json.loads(body)
+        parts = request['contents'][0]['parts']
+        toc = [line for part in parts if 'text' in part for line in part['text'].split('\n') if line.strip()]
+        file_uri = next(part['fileData']['fileUri'] for part in parts if 'fileData' in part)
+        name = file_uri.split('/v1beta/', 1)[1]
+
+        stored = self.state.get_file(name)
+        if stored is None:
+            self.send_error_json(404, f"File {name} not found", "NOT_FOUND")
+            return
+        _, clip_bytes = stored
+
+        number = synthetic.identify_chapter(clip_bytes)
+        if number is not None and number <= len(toc):
+            chapter = toc[number - 1]
+            if random.random() < self.state.wrong_answer:
+                chapter = random.choice(toc)
+            answer = {"containsChapter": True, "chapter": chapter}
+        else:
+            answer = {"containsChapter": False}
+        self.state.count('generate')
+
+        self.send_json(200, {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"text": json.dumps(answer)}]},
+                "finishReason": "STOP",
+                "index": 0
+            }],
+            "usageMetadata": {"promptTokenCount": 0, "candidatesTokenCount": 0, "totalTokenCount": 0}
+        })
+
+def serve(host, port, state):
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Local stand-in for the Gemini generative-language API")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8090)
+    arg_parser.add_argument('--latency', type=parse_latency, default='lognormal:800,0.4',
+                            help="generateContent latency: none, fixed:MS, uniform:LO,HI, normal:MEAN,SD or lognormal:MEDIAN,SIGMA")
+    arg_parser.add_argument('--error-429', type=float, default=0.0, help="fraction of requests answered with 429")
+    arg_parser.add_argument('--error-500', type=float, default=0.0, help="fraction of requests answered with 500")
+    arg_parser.add_argument('--rpm', type=int, default=None, help="requests per minute before returning 429 (free tier is 15)")
+    arg_parser.add_argument('--wrong-answer', type=float, default=0.0, help="fraction of chapter answers replaced with a random title")
+    arg_parser.add_argument('--file-ttl', type=float, default=600.0, help="seconds an uploaded clip stays available")
+    arg_parser.add_argument('--max-file-mb', type=float, default=256.0, help="memory for uploaded clips before the oldest are dropped")
+    args = arg_parser.parse_args()
+
+    state = StandinState(args.latency, args.error_429, args.error_500, args.rpm, args.wrong_answer,
+                         args.file_ttl, int(args.max_file_mb * 1024 * 1024))
+    server = serve(args.host, args.port, state)
+    logger.info(f"Gemini stand-in listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
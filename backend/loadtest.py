@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import synthetic
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# End-to-end load driver. Point the backend at gemini_standin.py through GEMINI_API_ENDPOINT,
+# then fire concurrent generate/export sessions at it with a synthetic book:
+#
+#   python gemini_standin.py --latency lognormal:800,0.4 --error-429 0.02 &
+#   GEMINI_API_KEY=fake GEMINI_API_ENDPOINT=http://127.0.0.1:8090 python app.py &
+#   python loadtest.py --sessions 40 --concurrency 8
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(operation, []).append(seconds)
+            self.errors.setdefault(operation, 0)
+            if not ok:
+                self.errors[operation] += 1
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return float('nan')
+    index = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[index]
+
+def timed(recorder, operation, func):
+    start = time.perf_counter()
+    ok = False
+    try:
+        response = func()
+        ok = response.ok
+        if not ok:
+            logger.warning(f"{operation} failed with {response.status_code}: {response.text[:200]}")
+        return response if ok else None
+    except requests.RequestException as e:
+        logger.warning(f"{operation} failed: {e}")
+        return None
+    finally:
+        recorder.record(operation, time.perf_counter() - start, ok)
+
+def run_session(backend, book_path, book_bytes, expected, recorder, num_silences):
+    filename = os.path.basename(book_path)
+    titles = [title for title, _ in expected]
+
+    generated = timed(recorder, 'generateChapters', lambda: requests.post(
+        f"{backend}/generateChapters",
+        files={'audioFile': (filename, book_bytes, 'audio/mpeg')},
+        data={
+            'tableOfContents': json.dumps(titles),
+            'numSilences': str(num_silences),
+            'sampleRate': str(synthetic.SAMPLE_RATE),
+            'existingChapters': '[]'
+        }
+    ))
+    if generated is None:
+        return False
+
+    chapters = generated.json()
+    exported = timed(recorder, 'exportChapters', lambda: requests.post(
+        f"{backend}/exportChapters",
+        files={'file': (filename, book_bytes, 'audio/mpeg')},
+        data={
+            'filename': filename,
+            'chapters': json.dumps(chapters),
+            'title': 'Synthetic Audiobook',
+            'author': 'Load Test'
+        }
+    ))
+    if exported is None:
+        return False
+
+    # The first chapter starts at 0 with no silence in front of it, so it is never generated
+    return sorted(c['title'] for c in chapters) == sorted(titles[1:])
+
+def report(recorder, wall_seconds, sessions, correct):
+    print()
+    print(f"{'operation':<18}{'count':>7}{'errors':>8}{'err %':>8}{'ops/s':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    for operation, samples in recorder.samples.items():
+        errors = recorder.errors[operation]
+        print(f"{operation:<18}{len(samples):>7}{errors:>8}{100 * errors / len(samples):>7.1f}%"
+              f"{len(samples) / wall_seconds:>8.2f}{percentile(samples, 0.50):>9.2f}"
+              f"{percentile(samples, 0.95):>9.2f}{percentile(samples, 0.99):>9.2f}")
+    print()
+    print(f"{sessions} sessions in {wall_seconds:.1f}s ({sessions / wall_seconds:.2f} sessions/s), "
+          f"{correct} with every chapter found")
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Concurrent generate/export load test against the backend")
+    arg_parser.add_argument('--backend', default='http://127.0.0.1:8089')
+    arg_parser.add_argument('--sessions', type=int, default=20)
+    arg_parser.add_argument('--concurrency', type=int, default=4)
+    arg_parser.add_argument('--chapters', type=int, default=10)
+    arg_parser.add_argument('--chapter-seconds', type=float, default=60.0)
+    arg_parser.add_argument('--book', default=None, help="reuse an existing synthetic book instead of generating one")
+    args = arg_parser.parse_args()
+
+    book_path = args.book or os.path.join(tempfile.gettempdir(), f"synthetic_{args.chapters}x{int(args.chapter_seconds)}.mp3")
+    if args.book is None or not os.path.exists(book_path):
+        expected = synthetic.generate_book(book_path, args.chapters, args.chapter_seconds)
+    else:
+        expected = list(zip(synthetic.chapter_titles(args.chapters), [None] * args.chapters))
+
+    with open(book_path, 'rb') as f:
+        book_bytes = f.read()
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(run_session, args.backend, book_path, book_bytes, expected, recorder, args.chapters - 1)
+            for _ in range(args.sessions)
+        ]
+        results = [future.result() for future in futures]
+    wall_seconds = time.perf_counter() - start
+
+    report(recorder, wall_seconds, args.sessions, sum(results))
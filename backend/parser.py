@@ -1,17 +1,20 @@
 from io import BytesIO
+import functools
 import json
 import logging
 import os
 import re
+import shutil
 import sys
 import subprocess
 import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
-import numpy as np
 from datetime import timedelta
-from tqdm import tqdm
-import google.generativeai as genai
-from google.ai.generativelanguage_v1beta.types import content
+
+import fingerprint
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,7 +24,55 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Encoders and filters the export and silence-detection paths rely on
+REQUIRED_ENCODERS = ('aac', 'mjpeg')
+REQUIRED_FILTERS = ('silencedetect',)
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_capabilities():
+    """
+    Probe ffmpeg and ffprobe once per process and cache what they support.
+    """
+    capabilities = {
+        'ffmpeg': shutil.which('ffmpeg') is not None,
+        'ffprobe': shutil.which('ffprobe') is not None,
+        'version': None,
+        'encoders': [],
+        'filters': []
+    }
+    if not capabilities['ffmpeg']:
+        logger.warning("ffmpeg not found on PATH")
+        return capabilities
+    if not capabilities['ffprobe']:
+        logger.warning("ffprobe not found on PATH")
+
+    def run(*args):
+        process = subprocess.run(['ffmpeg', '-hide_banner', *args], capture_output=True, text=True)
+        return process.stdout
+
+    version = run('-version').split('\n', 1)[0]
+    capabilities['version'] = version.split(' ')[2] if version.startswith('ffmpeg version') else version
+
+    # Lines look like " A....D aac                  AAC (Advanced Audio Coding)"
+    capabilities['encoders'] = sorted(
+        match.group(1) for match in re.finditer(r'^ [VAS][F.][S.][X.][B.][D.] (\S+)', run('-encoders'), re.MULTILINE)
+        if match.group(1) != '='
+    )
+    # Lines look like " ..C silencedetect      A->A       Detect silence."
+    capabilities['filters'] = sorted(
+        match.group(1) for match in re.finditer(r'^ [T.][S.][C.] (\S+)\s+\S+->\S+', run('-filters'), re.MULTILINE)
+    )
+
+    missing = [e for e in REQUIRED_ENCODERS if e not in capabilities['encoders']]
+    missing += [f for f in REQUIRED_FILTERS if f not in capabilities['filters']]
+    if missing:
+        logger.warning(f"ffmpeg is missing: {', '.join(missing)}")
+    logger.info(f"ffmpeg {capabilities['version']}: {len(capabilities['encoders'])} encoders, {len(capabilities['filters'])} filters")
+    return capabilities
+
 def extract_audio_data(file_path):
+    import numpy as np
+
     command = [
         'ffmpeg', '-i', file_path, '-f', 'wav', '-acodec', 'pcm_s16le', '-ar', '16000', '-ac', '1', 'pipe:1'
     ]
@@ -35,8 +86,17 @@ def extract_chapter_headers(file_bytes):
     ]
     process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, _ = process.communicate(input=file_bytes)
-    metadata = stdout.decode('utf-8')
-    
+    return parse_ffmetadata(stdout.decode('utf-8'))
+
+def extract_chapter_headers_from_path(audio_path):
+    command = [
+        'ffmpeg', '-i', audio_path, '-f', 'ffmetadata', '-'
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    return parse_ffmetadata(stdout.decode('utf-8'))
+
+def parse_ffmetadata(metadata):
     chapter_headers = []
     current_chapter = {}
     chapter_id = 1
@@ -83,47 +143,40 @@ def extract_chapter_headers(file_bytes):
         "author": author
     }
 
-def extract_thumbnail(file_bytes):
-    with tempfile.NamedTemporaryFile(delete=False) as audio_temp:
-        audio_temp.write(file_bytes)
-        audio_temp.flush()
-        audio_temp_path = audio_temp.name
-
+def extract_thumbnail(audio_path):
     # First, check if there's any video/image stream
-        probe_command = [
-            'ffprobe', '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=codec_type',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            audio_temp_path
-        ]
-        
-        probe_process = subprocess.Popen(probe_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        probe_stdout, _ = probe_process.communicate()
-        
-        # If there's no video stream, return None
-        if not probe_stdout.strip():
-            return None
+    probe_command = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=codec_type',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        audio_path
+    ]
+    
+    probe_process = subprocess.Popen(probe_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    probe_stdout, _ = probe_process.communicate()
+    
+    # If there's no video stream, return None
+    if not probe_stdout.strip():
+        return None
 
     # If we found a video stream, try to extract it
-    try:
-        command = [
-            'ffmpeg', '-y', '-i', audio_temp_path, '-an', '-vcodec', 'copy', '-f', 'image2', 'pipe:1'
-        ]
-        
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            raise RuntimeError(f"FFmpeg error: {stderr.decode('utf-8')}")
-        
-        return stdout
-    finally:
-        os.remove(audio_temp_path)
+    command = [
+        'ffmpeg', '-y', '-i', audio_path, '-an', '-vcodec', 'copy', '-f', 'image2', 'pipe:1'
+    ]
+    
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {stderr.decode('utf-8')}")
+    
+    return stdout
 
-def detect_silences(audio_path: str, noise_threshold_db: float = -60, min_silence_duration: float = 1) -> List[Tuple[float, float]]:
+def detect_silences(audio_path: str, noise_threshold_db: float = -60, min_silence_duration: float = 1, fingerprinter=None) -> List[Tuple[float, float]]:
     """
     Detect silent periods from a byte stream using ffmpeg's silencedetect filter.
+    If a fingerprint.Fingerprinter is given, it is fed from the same decode.
     """
     
     # Construct the ffmpeg command
@@ -132,9 +185,12 @@ def detect_silences(audio_path: str, noise_threshold_db: float = -60, min_silenc
         '-i', audio_path,
         '-acodec', 'pcm_s16le',  # Convert to raw PCM first
         '-af', f'silencedetect=noise={noise_threshold_db}dB:d={min_silence_duration}',
-        '-f', 'null',
-        '-'
     ]
+    if fingerprinter is not None:
+        # Keep the decoded audio instead of discarding it so it can be fingerprinted
+        cmd.extend([*fingerprint.ffmpeg_pcm_args(), 'pipe:1'])
+    else:
+        cmd.extend(['-f', 'null', '-'])
     
     # Run ffmpeg command and capture stderr output
     try:
@@ -145,7 +201,19 @@ def detect_silences(audio_path: str, noise_threshold_db: float = -60, min_silenc
             stderr=subprocess.PIPE,
             text=False
         )
-        _, stderr = process.communicate()
+        if fingerprinter is None:
+            _, stderr = process.communicate()
+        else:
+            process.stdin.close()
+            # Drain stderr on the side so neither pipe can fill up and stall ffmpeg
+            stderr_chunks = []
+            stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+            stderr_reader.start()
+            for block in iter(lambda: process.stdout.read(1024 * 1024), b''):
+                fingerprinter.feed(block)
+            process.wait()
+            stderr_reader.join()
+            stderr = stderr_chunks[0]
     except subprocess.CalledProcessError as e:
         logger.error(f"Error running ffmpeg: {e.stderr}")
         raise
@@ -172,6 +240,10 @@ def detect_silences(audio_path: str, noise_threshold_db: float = -60, min_silenc
     return silence_periods
 
 def find_silences(audio_data, silence_threshold, min_silence_len):
+    # Only this legacy path needs numpy/tqdm, keep them off the import path of the server
+    import numpy as np
+    from tqdm import tqdm
+
     # Ensure the buffer size is a multiple of 2 (16 bits = 2 bytes)
     buffer_length = len(audio_data)
     if buffer_length % 2 != 0:
@@ -258,7 +330,7 @@ def get_sample_rate(audio_data):
         except Exception as e:
             logger.warning(f"Warning: Could not remove temporary file {temp_path}: {e}")
 
-def find_largest_silences(audio_data, num_silences, num_existing, sample_rate, audiobook_path):
+def find_largest_silences(audio_data, num_silences, num_existing, sample_rate, audiobook_path, fingerprinter=None):
     logger.info(f"Using sample rate: {sample_rate} Hz")
     
     # Adjust threshold - now working with normalized values between 0 and 1
@@ -268,7 +340,7 @@ def find_largest_silences(audio_data, num_silences, num_existing, sample_rate, a
     logger.info(f"Silence threshold: {silence_threshold}")
     logger.info(f"Minimum silence length: {min_silence_len} samples")
     
-    silences = detect_silences(audiobook_path)
+    silences = detect_silences(audiobook_path, fingerprinter=fingerprinter)
     
     # Calculate silence durations and sort by duration
     silence_durations = [(start, end, end - start) for start, end in silences]
@@ -336,22 +408,20 @@ def construct_metadata(chapters, title, author, total_length_placeholder):
 
     return metadata
 
-def merge_metadata_with_audio(input_audio_stream, metadata_str, suffix, thumbnail_bytes=None):
+def merge_metadata_with_audio(audio_path, metadata_str, thumbnail_bytes=None):
     # Thumbnail present?
     if thumbnail_bytes:
         logger.info('Thumbnail detected')
     else:
         logger.info('No thumbnail detected')
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as audio_temp, \
-         tempfile.NamedTemporaryFile(delete=False) as metadata_temp, \
+    suffix = os.path.splitext(audio_path)[1].lower()
+
+    with tempfile.NamedTemporaryFile(delete=False) as metadata_temp, \
          tempfile.NamedTemporaryFile(delete=False, suffix='.m4b') as output_temp:
-        audio_temp.write(input_audio_stream)
         metadata_temp.write(metadata_str.encode('utf-8'))
-        audio_temp.flush()
         metadata_temp.flush()
         
-        audio_temp_path = audio_temp.name
         metadata_temp_path = metadata_temp.name
         output_temp_path = output_temp.name
     
@@ -360,7 +430,7 @@ def merge_metadata_with_audio(input_audio_stream, metadata_str, suffix, thumbnai
         # For M4B files, we can avoid transcoding and just copy the audio stream
         command = [
             'ffmpeg', '-y',
-            '-i', audio_temp_path,
+            '-i', audio_path,
             '-i', metadata_temp_path
         ]
         
@@ -417,12 +487,192 @@ def merge_metadata_with_audio(input_audio_stream, metadata_str, suffix, thumbnai
         
         return output_bytes
     finally:
-        os.remove(audio_temp_path)
         os.remove(metadata_temp_path)
         os.remove(output_temp_path)
         if 'cover_temp_path' in locals():
             os.remove(cover_temp_path)
 
+def split_output_extension(suffix):
+    """Pick the per-chapter container so the audio stream can be copied instead of re-encoded."""
+    if suffix in ['.aac', '.m4a', '.m4b']:
+        return '.m4a', True
+    if suffix == '.mp3':
+        return '.mp3', True
+    return '.m4a', False
+
+def cut_chapter(audio_path, output_path, start, end, tags, copy_codec, cover_path=None):
+    """
+    Cut [start, end) seconds out of audio_path into output_path with ffmpeg.
+    -ss is given before -i so ffmpeg seeks the input directly instead of decoding up to start.
+    """
+    command = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-ss', f'{start:.3f}',
+        '-i', audio_path
+    ]
+
+    if cover_path:
+        command.extend(['-i', cover_path])
+
+    if end is not None:
+        command.extend(['-t', f'{end - start:.3f}'])
+
+    command.extend([
+        '-map', '0:a',
+        '-map_metadata', '-1',  # Drop the book-level tags and chapters from the source
+        '-map_chapters', '-1'
+    ])
+
+    if cover_path:
+        command.extend([
+            '-map', '1',
+            '-c:v', 'mjpeg',
+            '-disposition:v', 'attached_pic'
+        ])
+
+    if copy_codec:
+        command.extend(['-c:a', 'copy'])
+    else:
+        command.extend(['-c:a', 'aac', '-b:a', '192k'])
+
+    for key, value in tags.items():
+        command.extend(['-metadata', f'{key}={value}'])
+
+    if output_path.endswith('.mp3'):
+        command.extend(['-id3v2_version', '3'])
+
+    command.append(output_path)
+
+    try:
+        subprocess.run(command, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error cutting chapter {tags.get('title')}: {e.stderr}")
+        raise RuntimeError(f"FFmpeg error: {e.stderr}")
+
+    return output_path
+
+def split_chapter_filename(index, total, title, extension):
+    # Keep filenames portable across the players that read them
+    safe_title = re.sub(r'[^\w\- ]+', '', title).strip() or 'Chapter'
+    width = max(2, len(str(total)))
+    return f"{str(index).zfill(width)} - {safe_title}{extension}"
+
+def check_chapter_times(chapters, total_length):
+    """Raise ValueError unless the chapter times, sorted, are strictly increasing and inside the book."""
+    try:
+        times = sorted(float(chapter['time']) for chapter in chapters)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("every chapter needs a numeric time")
+    total_seconds = total_length.total_seconds()
+    if times[0] < 0:
+        raise ValueError("chapter times can't be negative")
+    for previous, current in zip(times, times[1:]):
+        if current <= previous:
+            raise ValueError(f"two chapters start at {current:.3f}s")
+    if times[-1] >= total_seconds:
+        raise ValueError(f"chapter at {times[-1]:.3f}s is past the end of the book ({total_seconds:.3f}s)")
+
+def split_audio_by_chapters(audio_path, chapters, title, author, total_length, thumbnail_bytes=None, max_workers=None):
+    """
+    Cut audio_path into one file per chapter, running the ffmpeg cuts concurrently.
+    Yields (filename, path) in chapter order as each cut finishes. Files live in a temp
+    directory that is removed once the generator is exhausted or closed.
+    """
+    suffix = os.path.splitext(audio_path)[1].lower()
+    extension, copy_codec = split_output_extension(suffix)
+    if copy_codec:
+        logger.info(f'Splitting with copy codec into {extension} files')
+    else:
+        logger.info(f'Transcoding chapters to AAC for {suffix} input')
+
+    chapters = sorted(chapters, key=lambda x: float(x['time']))
+    total = len(chapters)
+    total_seconds = total_length.total_seconds()
+    output_dir = tempfile.mkdtemp()
+
+    cover_path = None
+    if thumbnail_bytes:
+        cover_path = os.path.join(output_dir, 'cover.jpg')
+        with open(cover_path, 'wb') as f:
+            f.write(thumbnail_bytes)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 4
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        jobs = []
+        for i, chapter in enumerate(chapters):
+            start = 0 if i == 0 else float(chapter['time'])
+            end = float(chapters[i + 1]['time']) if i < total - 1 else total_seconds
+            filename = split_chapter_filename(i + 1, total, chapter['title'], extension)
+            tags = {
+                'track': f'{i + 1}/{total}',
+                'title': chapter['title'],
+                'artist': author,
+                'album_artist': author,
+                'album': title
+            }
+            output_path = os.path.join(output_dir, filename)
+            future = executor.submit(cut_chapter, audio_path, output_path, start, end, tags, copy_codec, cover_path)
+            jobs.append((filename, future))
+
+        for filename, future in jobs:
+            yield filename, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+class _ZipStreamBuffer:
+    """Write-only sink for ZipFile that hands back whatever was written since the last drain."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(files, chunk_size=1024 * 1024):
+    """
+    Zip (filename, path) pairs on the fly, yielding the archive in pieces so it is never
+    held in memory. Audio is already compressed, so entries are stored rather than deflated.
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for filename, path in files:
+            with open(path, 'rb') as src, archive.open(filename, mode='w', force_zip64=True) as dest:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+    # Closing the archive writes the central directory
+    yield buffer.drain()
+
+def get_audio_duration(path):
+    command = [
+        'ffprobe', 
+        '-v', 'error', 
+        '-i', path,
+        '-show_entries', 'format=duration', 
+        '-of', 'default=noprint_wrappers=1:nokey=1', 
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    duration_seconds = float(stdout.strip())
+    return timedelta(seconds=duration_seconds)
+
 def get_audio_length(file_bytes, suffix):
     with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
         temp_path = temp_file.name
@@ -430,17 +680,7 @@ def get_audio_length(file_bytes, suffix):
         temp_file.flush()
 
     try:
-        command = [
-            'ffprobe', 
-            '-v', 'error', 
-            '-i', temp_path,
-            '-show_entries', 'format=duration', 
-            '-of', 'default=noprint_wrappers=1:nokey=1', 
-        ]
-        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, _ = process.communicate(input=file_bytes)
-        duration_seconds = float(stdout.strip())
-        return timedelta(seconds=duration_seconds)
+        return get_audio_duration(temp_path)
     finally:
         if os.path.exists(temp_path):
             os.remove(temp_path)
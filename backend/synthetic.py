@@ -0,0 +1,106 @@
+import logging
+import subprocess
+import sys
+import numpy as np
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+# Synthetic audiobooks for offline testing. Every chapter opens with a marker tone whose
+# pitch encodes the chapter number, so a clip taken after a silence can be "recognised"
+# without a real model.
+SAMPLE_RATE = 16000
+MARKER_BASE_HZ = 600
+MARKER_STEP_HZ = 40
+MARKER_SECONDS = 2.0
+NARRATION_HZ = 220
+CHAPTER_GAP_SECONDS = 4.0
+PARAGRAPH_GAP_SECONDS = 1.2
+
+def chapter_titles(num_chapters):
+    return [f"Chapter {i}" for i in range(1, num_chapters + 1)]
+
+def marker_frequency(chapter_number):
+    return MARKER_BASE_HZ + MARKER_STEP_HZ * chapter_number
+
+def _tone(frequency, seconds, amplitude=0.3):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+def _silence(seconds):
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+
+def generate_book(output_path, num_chapters=10, chapter_seconds=60.0, seed=0):
+    """
+    Render a synthetic audiobook to output_path (any format ffmpeg can encode from its extension).
+    Chapters are separated by the longest silences in the file, with shorter paragraph pauses
+    inside each chapter as decoys. Returns the list of (title, start_seconds).
+    """
+    rng = np.random.default_rng(seed)
+    segments = []
+    chapters = []
+    position = 0.0
+
+    for number in range(1, num_chapters + 1):
+        if number > 1:
+            segments.append(_silence(CHAPTER_GAP_SECONDS))
+            position += CHAPTER_GAP_SECONDS
+        chapters.append((f"Chapter {number}", position))
+
+        segments.append(_tone(marker_frequency(number), MARKER_SECONDS))
+        position += MARKER_SECONDS
+
+        # Narration: a steady tone broken up by paragraph pauses
+        remaining = max(chapter_seconds - MARKER_SECONDS, 0)
+        while remaining > 0:
+            paragraph = min(remaining, rng.uniform(5, 15))
+            segments.append(_tone(NARRATION_HZ, paragraph, amplitude=0.2))
+            remaining -= paragraph
+            position += paragraph
+            if remaining > PARAGRAPH_GAP_SECONDS:
+                segments.append(_silence(PARAGRAPH_GAP_SECONDS))
+                remaining -= PARAGRAPH_GAP_SECONDS
+                position += PARAGRAPH_GAP_SECONDS
+
+    pcm = (np.concatenate(segments) * 32767).astype(np.int16)
+    command = [
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+        '-metadata', 'title=Synthetic Audiobook',
+        '-metadata', 'artist=Load Test',
+        output_path
+    ]
+    process = subprocess.run(command, input=pcm.tobytes(), capture_output=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg error: {process.stderr.decode('utf-8')}")
+
+    logger.info(f"Generated synthetic book with {num_chapters} chapters ({position:.0f}s) at {output_path}")
+    return chapters
+
+def identify_chapter(clip_bytes):
+    """
+    Return the chapter number whose marker tone opens clip_bytes, or None if the clip starts
+    with narration or anything else.
+    """
+    command = [
+        'ffmpeg', '-v', 'error', '-i', 'pipe:0',
+        '-t', str(MARKER_SECONDS),
+        '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', 'pipe:1'
+    ]
+    process = subprocess.run(command, input=clip_bytes, capture_output=True)
+    samples = np.frombuffer(process.stdout, dtype=np.int16).astype(np.float32)
+    if len(samples) < SAMPLE_RATE // 4 or not np.any(samples):
+        return None
+
+    spectrum = np.abs(np.fft.rfft(samples * np.hanning(len(samples))))
+    peak_hz = np.argmax(spectrum) * SAMPLE_RATE / len(samples)
+
+    number = int(round((peak_hz - MARKER_BASE_HZ) / MARKER_STEP_HZ))
+    if number < 1 or abs(peak_hz - marker_frequency(number)) > MARKER_STEP_HZ / 4:
+        return None
+    return number
@@ -0,0 +1,80 @@
+import os
+import random
+import tempfile
+import unittest
+from array import array
+
+import fingerprint
+
+# Lookups work on hashes, so these build them directly instead of decoding audio (no numpy or
+# ffmpeg needed):
+#
+#   python -m pytest test_fingerprint.py
+
+BOOK_FRAMES = 3000
+OFFSET_FRAMES = 23
+QUERY_FRAMES = 2400
+
+def random_hashes(rng, count):
+    return array('I', (rng.getrandbits(32) | 1 for _ in range(count)))
+
+def reencoded_query(rng, book):
+    """
+    Head anchors for book as heard from another encoding starting OFFSET_FRAMES later: every
+    hash loses 7 bits, except one in 50 that only loses 2 of its weak bits and can be found as a
+    near miss. That is a bit error rate of about 0.21 with a few dozen votes.
+    """
+    anchors = []
+    for i in range(QUERY_FRAMES):
+        h = book[i + OFFSET_FRAMES]
+        positions = rng.sample(range(fingerprint.NUM_BITS), fingerprint.WEAK_BITS + 7)
+        weak = positions[:fingerprint.WEAK_BITS]
+        flipped = weak[:2] if i % 50 == 0 else positions[fingerprint.WEAK_BITS:]
+        for bit in flipped:
+            h ^= 1 << bit
+        anchors.append((i * fingerprint.HOP_SECONDS, h, sum(1 << bit for bit in weak)))
+    return anchors
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.index = fingerprint.FingerprintIndex(self.path)
+        self.rng = random.Random(7)
+        self.book = random_hashes(self.rng, BOOK_FRAMES)
+        chapters = [{'id': '1', 'time': 0, 'title': 'One'}, {'id': '2', 'time': 150.0, 'title': 'Two'}]
+        self.index.add_book('book', self.book, chapters, 'Book', 'Author', BOOK_FRAMES * fingerprint.HOP_SECONDS)
+        self.anchors = reencoded_query(self.rng, self.book)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def assert_matches_book(self, match):
+        self.assertIsNotNone(match)
+        self.assertEqual(match['title'], 'Book')
+        self.assertAlmostEqual(match['offset'], -OFFSET_FRAMES * fingerprint.HOP_SECONDS)
+        self.assertLessEqual(match['bitErrorRate'], fingerprint.MAX_BIT_ERROR_RATE)
+        self.assertAlmostEqual(match['chapters'][1]['time'], 150.0 - OFFSET_FRAMES * fingerprint.HOP_SECONDS)
+
+    def test_matches_through_near_misses(self):
+        self.assert_matches_book(self.index.lookup(self.anchors))
+
+    def test_long_decoy_does_not_outvote_the_book(self):
+        # An 18 hour book holding every query hash three times at scattered frames: far more
+        # votes in total than the real book gets, but never two on the same offset
+        decoy = random_hashes(self.rng, 18 * 3600 * 10)
+        for _, h, _ in self.anchors:
+            for _ in range(3):
+                decoy[self.rng.randrange(len(decoy))] = h
+        self.index.add_book('decoy', decoy, [{'id': '1', 'time': 0, 'title': 'Decoy'}], 'Decoy', 'Author', len(decoy) / 10)
+
+        self.assert_matches_book(self.index.lookup(self.anchors))
+
+    def test_unrelated_query_is_rejected(self):
+        anchors = [(i * fingerprint.HOP_SECONDS, h, 0) for i, h in enumerate(random_hashes(self.rng, QUERY_FRAMES))]
+        self.assertIsNone(self.index.lookup(anchors))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+# Uploads untouched for this long are swept, whether they finished or were abandoned
+DEFAULT_TTL_HOURS = 24
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadStore:
+    """
+    Chunked, resumable uploads kept on disk so they survive worker restarts.
+
+    Each upload is a directory holding meta.json, the preallocated audio file and one
+    empty marker file per received chunk. Chunks are written straight into the audio file
+    at their offset, so they can arrive in any order and from several connections at once.
+    """
+
+    def __init__(self, root=None, ttl_hours=DEFAULT_TTL_HOURS):
+        self.root = root or os.path.join(tempfile.gettempdir(), 'audiobook-uploads')
+        self.ttl_seconds = ttl_hours * 3600
+
+    def _touch(self, upload_dir):
+        # The directory's mtime is the upload's last activity, see sweep()
+        os.utime(upload_dir)
+
+    def sweep(self):
+        """Remove uploads with no activity within the TTL."""
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    logger.info(f"Removed expired upload {name}")
+            except FileNotFoundError:
+                pass
+
+    def _upload_dir(self, upload_id):
+        # Ids are generated by us; reject anything else so they can't escape the root
+        try:
+            upload_id = uuid.UUID(upload_id).hex
+        except (ValueError, TypeError):
+            raise UploadError("unknown upload", 404)
+        path = os.path.join(self.root, upload_id)
+        if not os.path.isdir(path):
+            raise UploadError("unknown upload", 404)
+        return path
+
+    def _read_meta(self, upload_id):
+        try:
+            with open(os.path.join(self._upload_dir(upload_id), 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # create() didn't get as far as writing it
+            raise UploadError("unknown upload", 404)
+
+    def _write_meta(self, upload_dir, meta):
+        # Write then rename, so readers and a restarted worker only ever see a whole file
+        fd, temp_path = tempfile.mkstemp(dir=upload_dir, prefix='meta.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, os.path.join(upload_dir, 'meta.json'))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _chunk_bounds(self, meta, index):
+        if index < 0 or index >= meta['totalChunks']:
+            raise UploadError(f"chunk index must be between 0 and {meta['totalChunks'] - 1}")
+        offset = index * meta['chunkSize']
+        length = min(meta['chunkSize'], meta['size'] - offset)
+        return offset, length
+
+    def create(self, filename, size, chunk_size=DEFAULT_CHUNK_SIZE):
+        if size <= 0 or size > MAX_UPLOAD_SIZE:
+            raise UploadError(f"size must be between 1 and {MAX_UPLOAD_SIZE}")
+        if chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+            raise UploadError(f"chunkSize must be between 1 and {MAX_CHUNK_SIZE}")
+
+        # The root is only made once something is uploaded, so importing app leaves no trace
+        os.makedirs(self.root, exist_ok=True)
+        self.sweep()
+        if shutil.disk_usage(self.root).free < size:
+            raise UploadError("not enough disk space for this upload", 507)
+
+        upload_id = uuid.uuid4().hex
+        upload_dir = os.path.join(self.root, upload_id)
+        os.makedirs(os.path.join(upload_dir, 'chunks'))
+
+        # Reserve the whole file up front so chunk writes never have to grow it
+        suffix = os.path.splitext(filename)[1].lower()
+        data_path = os.path.join(upload_dir, 'data' + suffix)
+        try:
+            fd = os.open(data_path, os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            logger.error(f"Could not reserve {size} bytes for {filename}: {e}")
+            raise UploadError("could not reserve space for this upload", 507)
+
+        meta = {
+            'uploadId': upload_id,
+            'filename': filename,
+            'size': size,
+            'chunkSize': chunk_size,
+            'totalChunks': (size + chunk_size - 1) // chunk_size,
+            'dataPath': data_path,
+            'complete': False
+        }
+        self._write_meta(upload_dir, meta)
+
+        logger.info(f"Created upload {upload_id} for {filename} ({size} bytes, {meta['totalChunks']} chunks)")
+        return meta
+
+    def write_chunk(self, upload_id, index, stream):
+        meta = self._read_meta(upload_id)
+        if meta['complete']:
+            raise UploadError("upload is already complete", 409)
+        offset, length = self._chunk_bounds(meta, index)
+
+        # A resent chunk overwrites bytes in place, so it only counts as received again once it
+        # has fully arrived; otherwise a cut-short retry would corrupt a chunk still listed as done
+        upload_dir = self._upload_dir(upload_id)
+        marker = os.path.join(upload_dir, 'chunks', str(index))
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+        self._touch(upload_dir)
+
+        written = 0
+        fd = os.open(meta['dataPath'], os.O_WRONLY)
+        try:
+            while written < length:
+                data = stream.read(min(COPY_BUFFER_SIZE, length - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+            extra = stream.read(1)
+        finally:
+            os.close(fd)
+
+        if written != length or extra:
+            raise UploadError(f"chunk {index} must be exactly {length} bytes")
+
+        # Only mark the chunk once its bytes are in place
+        open(marker, 'w').close()
+        return written
+
+    def received_chunks(self, upload_id):
+        chunk_dir = os.path.join(self._upload_dir(upload_id), 'chunks')
+        return sorted(int(name) for name in os.listdir(chunk_dir))
+
+    def status(self, upload_id):
+        meta = self._read_meta(upload_id)
+        return {
+            'uploadId': meta['uploadId'],
+            'filename': meta['filename'],
+            'size': meta['size'],
+            'chunkSize': meta['chunkSize'],
+            'totalChunks': meta['totalChunks'],
+            'received': self.received_chunks(upload_id),
+            'complete': meta['complete']
+        }
+
+    def finalize(self, upload_id, sha256):
+        meta = self._read_meta(upload_id)
+        if meta['complete']:
+            return meta
+
+        received = set(self.received_chunks(upload_id))
+        missing = [i for i in range(meta['totalChunks']) if i not in received]
+        if missing:
+            raise UploadError(f"{len(missing)} chunks missing, first is {missing[0]}", 409)
+
+        if file_sha256(meta['dataPath']) != sha256.lower():
+            # We can't tell which chunk is bad, so make the client send them all again
+            chunk_dir = os.path.join(self._upload_dir(upload_id), 'chunks')
+            for name in os.listdir(chunk_dir):
+                os.remove(os.path.join(chunk_dir, name))
+            logger.warning(f"Checksum mismatch for upload {upload_id}")
+            raise UploadError("sha256 mismatch, all chunks must be uploaded again", 422)
+
+        meta['complete'] = True
+        meta['sha256'] = sha256.lower()
+        self._write_meta(self._upload_dir(upload_id), meta)
+
+        logger.info(f"Upload {upload_id} complete")
+        return meta
+
+    def get_completed(self, upload_id):
+        """Return (filename, path, sha256) of a finished upload."""
+        meta = self._read_meta(upload_id)
+        if not meta['complete']:
+            raise UploadError("upload is not complete", 409)
+        self._touch(self._upload_dir(upload_id))
+        return meta['filename'], meta['dataPath'], meta.get('sha256')
+
+    def delete(self, upload_id):
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
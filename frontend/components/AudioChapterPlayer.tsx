@@ -3,6 +3,7 @@
 import { useState, useRef, type ChangeEvent, type RefObject } from "react";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
+import { ToggleGroup, ToggleGroupItem } from "@/components/ui/toggle-group";
 import AudioPlayer from "./AudioPlayer";
 import ChapterMarks from "./ChapterMarks";
 import { Loader2, Upload, Wand2, Download } from "lucide-react";
@@ -22,6 +23,7 @@ export default function AudioChapterPlayer() {
   const [audiobookTitle, setAudiobookTitle] = useState("Untitled Audiobook");
   const [audiobookAuthor, setAudiobookAuthor] = useState("Unknown Author");
   const [isTextModalOpen, setIsTextModalOpen] = useState(false);
+  const [exportMode, setExportMode] = useState<"m4b" | "files">("m4b");
 
   const getSampleRate = async (audioRef: RefObject<HTMLAudioElement>): Promise<number> => {
     // Create a temporary audio context to get the real sample rate
@@ -182,7 +184,10 @@ export default function AudioChapterPlayer() {
         thumbnailFile = new File([blob], "cover.jpg", { type: blob.type });
       }
 
-      const blob = await chapterClient.exportChapters(
+      const exportBook = exportMode === "files"
+        ? chapterClient.exportChapterFiles.bind(chapterClient)
+        : chapterClient.exportChapters.bind(chapterClient);
+      const blob = await exportBook(
         file,
         file.name,
         chapters,
@@ -195,7 +200,7 @@ export default function AudioChapterPlayer() {
 
       const a = document.createElement("a");
       a.href = url;
-      a.download = `${file.name.split(".")[0]}.m4b`;
+      a.download = `${file.name.split(".")[0]}.${exportMode === "files" ? "zip" : "m4b"}`;
       document.body.appendChild(a);
       a.click();
       document.body.removeChild(a);
@@ -302,6 +307,15 @@ export default function AudioChapterPlayer() {
             currentAudioTime={currentAudioTime}
             onJumpToChapter={handleJumpToChapter}
           />
+          <ToggleGroup
+            type="single"
+            value={exportMode}
+            onValueChange={(value) => value && setExportMode(value as "m4b" | "files")}
+            className="justify-start"
+          >
+            <ToggleGroupItem value="m4b">Single m4b</ToggleGroupItem>
+            <ToggleGroupItem value="files">One file per chapter</ToggleGroupItem>
+          </ToggleGroup>
           <Button
             onClick={handleExport}
             className="w-full bg-green-600 hover:bg-green-700"
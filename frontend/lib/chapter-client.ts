@@ -1,22 +1,174 @@
+import { Sha256 } from './sha256'
+
 export interface Chapter {
   id: string
   time: number
   title: string
 }
 
+export interface FingerprintMatch {
+  title: string
+  author: string
+  offset: number
+  drift: number
+  bitErrorRate: number
+}
+
 export interface ChapterResponse {
   chapters: Chapter[]
   title: string
   author: string
   thumbnail?: string
+  // Present when the chapters were reused from an earlier export of another encoding
+  fingerprintMatch?: FingerprintMatch
 }
 
+interface UploadStatus {
+  uploadId: string
+  chunkSize: number
+  totalChunks: number
+  received: number[]
+  complete: boolean
+}
+
+const BASE_URL = 'http://127.0.0.1:8089';
+const CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_CONCURRENCY = 4;
+const CHUNK_RETRIES = 5;
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
 class ChapterClient {
+  // One chunked upload per file, shared by every request that needs the audio
+  private uploads = new WeakMap<File, Promise<string>>();
+
+  uploadAudio(file: File, onProgress?: (fraction: number) => void): Promise<string> {
+    let upload = this.uploads.get(file);
+    if (!upload) {
+      upload = this.runUpload(file, onProgress);
+      // Forget failed uploads so the next call resumes them from the server's chunk list
+      upload.catch(() => this.uploads.delete(file));
+      this.uploads.set(file, upload);
+    }
+    return upload;
+  }
+
+  private uploadKey(file: File): string {
+    return `upload:${file.name}:${file.size}:${file.lastModified}`;
+  }
+
+  private async getUploadStatus(uploadId: string): Promise<UploadStatus | null> {
+    const response = await fetch(`${BASE_URL}/uploads/${uploadId}`);
+    return response.ok ? await response.json() : null;
+  }
+
+  private async startUpload(file: File): Promise<UploadStatus> {
+    const savedId = localStorage.getItem(this.uploadKey(file));
+    if (savedId) {
+      const status = await this.getUploadStatus(savedId);
+      if (status) {
+        console.log(`Resuming upload ${savedId}, ${status.received.length}/${status.totalChunks} chunks on server`);
+        return status;
+      }
+    }
+
+    const response = await fetch(`${BASE_URL}/uploads`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ filename: file.name, size: file.size, chunkSize: CHUNK_SIZE }),
+    });
+    if (!response.ok) {
+      const errorData = await response.json();
+      throw new Error(errorData.error || 'Failed to start upload');
+    }
+
+    const status: UploadStatus = await response.json();
+    localStorage.setItem(this.uploadKey(file), status.uploadId);
+    return status;
+  }
+
+  private async putChunk(file: File, status: UploadStatus, index: number) {
+    const start = index * status.chunkSize;
+    const chunk = file.slice(start, Math.min(start + status.chunkSize, file.size));
+
+    for (let attempt = 1; ; attempt++) {
+      let response: Response | null = null;
+      try {
+        response = await fetch(`${BASE_URL}/uploads/${status.uploadId}/chunks/${index}`, {
+          method: 'PUT',
+          body: chunk,
+        });
+      } catch (error) {
+        // Network failure, worth retrying
+        if (attempt >= CHUNK_RETRIES) {
+          throw error;
+        }
+      }
+
+      if (response?.ok) {
+        return;
+      }
+      if (response && response.status < 500) {
+        const errorData = await response.json();
+        throw new Error(errorData.error || `Failed to upload chunk ${index}`);
+      }
+      if (attempt >= CHUNK_RETRIES) {
+        throw new Error(`Failed to upload chunk ${index}`);
+      }
+      await sleep(500 * 2 ** attempt);
+    }
+  }
+
+  private async hashFile(file: File): Promise<string> {
+    const hash = new Sha256();
+    for (let start = 0; start < file.size; start += CHUNK_SIZE) {
+      const buffer = await file.slice(start, start + CHUNK_SIZE).arrayBuffer();
+      hash.update(new Uint8Array(buffer));
+    }
+    return hash.hex();
+  }
+
+  private async runUpload(file: File, onProgress?: (fraction: number) => void): Promise<string> {
+    const status = await this.startUpload(file);
+    if (status.complete) {
+      return status.uploadId;
+    }
+
+    // Hash while the chunks are in flight; the server checks it on completion
+    const digest = this.hashFile(file);
+
+    const received = new Set(status.received);
+    const pending = Array.from({ length: status.totalChunks }, (_, i) => i).filter(i => !received.has(i));
+    let done = received.size;
+    onProgress?.(done / status.totalChunks);
+
+    const worker = async () => {
+      for (let index = pending.shift(); index !== undefined; index = pending.shift()) {
+        await this.putChunk(file, status, index);
+        done++;
+        onProgress?.(done / status.totalChunks);
+      }
+    };
+    await Promise.all(Array.from({ length: UPLOAD_CONCURRENCY }, worker));
+
+    const response = await fetch(`${BASE_URL}/uploads/${status.uploadId}/complete`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ sha256: await digest }),
+    });
+    if (!response.ok) {
+      const errorData = await response.json();
+      throw new Error(errorData.error || 'Failed to complete upload');
+    }
+
+    return status.uploadId;
+  }
+
   async loadChapters(audioFile: File): Promise<ChapterResponse> {
     const formData = new FormData();
-    formData.append('audiobook', audioFile);
+    formData.append('uploadId', await this.uploadAudio(audioFile));
 
-    const response = await fetch('http://127.0.0.1:8089/detectChapters', {
+    const response = await fetch(`${BASE_URL}/detectChapters`, {
       method: 'POST',
       body: formData,
     });
@@ -31,6 +183,7 @@ class ChapterClient {
       title: data.title,
       author: data.author,
       thumbnail: data.thumbnail,
+      fingerprintMatch: data.fingerprintMatch,
     };
   }
 
@@ -43,7 +196,7 @@ class ChapterClient {
   ): Promise<Chapter[]> {
     const formData = new FormData();
     formData.append('tableOfContents', JSON.stringify(text.split('\n').filter(line => line.trim())));
-    formData.append('audioFile', audioFile);
+    formData.append('uploadId', await this.uploadAudio(audioFile));
     formData.append('numSilences', numSilences.toString());
     formData.append('sampleRate', sampleRate.toString());
     formData.append('existingChapters', JSON.stringify(existingChapters));
@@ -54,7 +207,7 @@ class ChapterClient {
     }
 
     try {
-      const response = await fetch('http://127.0.0.1:8089/generateChapters', {
+      const response = await fetch(`${BASE_URL}/generateChapters`, {
         method: 'POST',
         body: formData,
       });
@@ -90,7 +243,7 @@ class ChapterClient {
 
   async exportChapters(file: File, filename: string, chapters: Chapter[], title: string, author: string, thumbnail?: File): Promise<Blob> {
     const formData = new FormData();
-    formData.append('file', file);
+    formData.append('uploadId', await this.uploadAudio(file));
     formData.append('filename', filename);
     formData.append('chapters', JSON.stringify(chapters));
     formData.append('title', title);
@@ -99,7 +252,7 @@ class ChapterClient {
       formData.append('thumbnail', thumbnail);
     }
 
-    const response = await fetch('http://127.0.0.1:8089/exportChapters', {
+    const response = await fetch(`${BASE_URL}/exportChapters`, {
       method: 'POST',
       body: formData,
     });
@@ -111,6 +264,39 @@ class ChapterClient {
 
     return await response.blob();
   }
+
+  async exportChapterFiles(file: File, filename: string, chapters: Chapter[], title: string, author: string, thumbnail?: File): Promise<Blob> {
+    const formData = new FormData();
+    formData.append('uploadId', await this.uploadAudio(file));
+    formData.append('filename', filename);
+    formData.append('chapters', JSON.stringify(chapters));
+    formData.append('title', title);
+    formData.append('author', author);
+    if (thumbnail) {
+      formData.append('thumbnail', thumbnail);
+    }
+
+    const response = await fetch(`${BASE_URL}/exportChapterFiles`, {
+      method: 'POST',
+      body: formData,
+    });
+
+    if (!response.ok) {
+      const errorData = await response.json();
+      throw new Error(errorData.error || 'Failed to export chapter files');
+    }
+
+    const blob = await response.blob();
+
+    // A complete archive ends with the zip end-of-central-directory record listing every chapter
+    const tail = new DataView(await blob.slice(Math.max(blob.size - 22, 0)).arrayBuffer());
+    const expected = Number(response.headers.get('X-Chapter-Count') ?? chapters.length);
+    if (tail.byteLength < 22 || tail.getUint32(0, true) !== 0x06054b50 || tail.getUint16(10, true) !== expected) {
+      throw new Error('Chapter file export was cut short, please try again');
+    }
+
+    return blob;
+  }
 }
 
 export const chapterClient = new ChapterClient()